@@ -1,24 +1,20 @@
-from importlib.resources import path
 import logging
 import sys
 import time
+from typing import Optional
 import click
 
-from pathlib import Path
-
 from note_hammer.note_hammer import NoteHammer
 
 
 timestamp = time.strftime("%Y-%m-%d_%H-%M-%S_%p")
 logging.basicConfig(
-    filename=fr"{timestamp}.log",
-    filemode='a',
+    handlers=[logging.FileHandler(fr"{timestamp}.log", mode='a', delay=True)], # delay: the file is only created once a command logs, not for --help
     format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
     datefmt='%H:%M:%S',
     level=logging.DEBUG
 )
 logging.getLogger().addHandler(logging.StreamHandler())
-logging.info(f"Starting NoteHammer at {timestamp}")
 
 @click.group()
 def cli():
@@ -32,7 +28,13 @@ def cli():
 @click.option('-dt', '--default-tags', multiple=True, help='Tags to be added to all the notes. This option can be used multiple times to add multiple tags.')
 @click.option('-o', '--overwrite-older-notes', is_flag=True, help='Include this flag for overwriting older notes with the same name in the output path.')
 @click.option('-sc', '--skip-confirmation', is_flag=True, help='Confirm before processing the notes.')
-def extract_kindle(input_path: str, output_path: str, backup_path: str, default_tags: list[str], overwrite_older_notes: bool, skip_confirmation: bool):
+@click.option('-mb', '--max-backups', default=0, type=click.IntRange(min=0), help='Number of most recent backups to keep in the backup path, older backups are deleted. 0 keeps all backups.')
+@click.option('-cp', '--cache_path', default=r".\.note-hammer-cache", help='Path to the folder where parsed notes are cached, so unchanged html files are not parsed again. Empty string disables the cache.')
+@click.option('-cc', '--clean-cache', is_flag=True, help='Include this flag for deleting the note cache before processing the notes.')
+@click.option('-j', '--jobs', default=None, type=click.IntRange(min=1), help='Number of worker processes parsing the html files. Defaults to the number of CPUs.')
+def extract_kindle(input_path: str, output_path: str, backup_path: str, default_tags: list[str], overwrite_older_notes: bool, skip_confirmation: bool, max_backups: int, cache_path: str, clean_cache: bool, jobs: Optional[int]):
+    # logged here and not in the cli group, click runs the group before the command parses --help
+    logging.info(f"Starting NoteHammer at {timestamp}")
     if not skip_confirmation:
         click.confirm(f'Are you sure you want to process the notes in {input_path}?', abort=True)
     
@@ -42,7 +44,11 @@ def extract_kindle(input_path: str, output_path: str, backup_path: str, default_
         backup_path=backup_path,
         default_tags=default_tags,
         overwrite_older_notes=overwrite_older_notes, 
-        skip_confirmation=skip_confirmation
+        skip_confirmation=skip_confirmation,
+        max_backups=max_backups,
+        cache_path=cache_path,
+        clean_cache=clean_cache,
+        jobs=jobs
     )
     
     note_hammer.process_kindle_notes()
@@ -1,10 +1,21 @@
+from collections import defaultdict
 from dataclasses import dataclass
-from functools import cache
 import os
+from pathlib import Path
 import re
 import time
+from typing import Optional
+import warnings
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer, XMLParsedAsHTMLWarning
+
+_TITLE_TAGS_PATTERN = re.compile(r"\w+ \[(.*)\]\s*$")
+_AUTHOR_SEPARATORS_PATTERN = re.compile("[.,! ]")
+_KINDLE_NOTEBOOK_DIVS = SoupStrainer('div', {'class': ['bookTitle', 'authors', 'citation', 'sectionHeading', 'noteText']})
+
+# Kindle exports are XHTML with an <?xml prolog, the html parser handles them fine, so the warning is only noise
+# set at import time, so worker processes importing this module get the filter too
+warnings.filterwarnings("ignore", category=XMLParsedAsHTMLWarning)
 
 @dataclass(eq=True, frozen=True)
 class Note():
@@ -14,60 +25,50 @@ class Note():
     tags: frozenset[str]
     sections_to_notes: frozenset[tuple[str, frozenset[str]]]
     
-    # def __str__(self):
-    #     return f"Title: {self.title}
-    
-    def __eq__(self, other):
-        if not isinstance(other, Note):
-            return NotImplemented
-        return self.title == other.title and \
-               self.authors == other.authors and \
-               self.citation == other.citation and \
-               self.tags == other.tags and \
-               self.sections_to_notes == other.sections_to_notes
-    
     @classmethod
     def from_kindle_html(cls, html_path: str, default_tags: list[str]):
         assert os.path.splitext(html_path)[1] == ".html"
-        with open(html_path, encoding='utf-8') as fp:
-            # content = fp.read()
-            soup = BeautifulSoup(fp, 'html.parser')
-            # print(soup)
+        # the whole file as raw bytes in a single read
+        return cls.from_kindle_html_bytes(Path(html_path).read_bytes(), default_tags=default_tags)
 
-            title = soup.find('div', {'class': ['bookTitle']})
-            authors = soup.find('div', {'class': ['authors']})
-            citation = soup.find('div', {'class': ['citation']})
-            # sectionHeadings = soup.find('div', {'class': ['sectionHeading']})
+    @classmethod
+    def from_kindle_html_bytes(cls, html: bytes, default_tags: list[str]):
+        # raw bytes, the parser detects the encoding from the document itself
+        soup = BeautifulSoup(html, 'lxml', parse_only=_KINDLE_NOTEBOOK_DIVS)
 
-            all_note_texts = soup.find_all('div', {'class': ['noteText']})
-            sections_to_notes: dict[str, list[str]] = {}
-            for note_text in all_note_texts:
-                section_heading = cls.remove_leading_and_trailing_newlines(note_text.find_previous_sibling('div', {'class': {'sectionHeading'}}).text)
-                if section_heading not in sections_to_notes:
-                    sections_to_notes[section_heading] = []
-                sections_to_notes[section_heading].append(cls.remove_leading_and_trailing_newlines(note_text.text))
-            
-            frozen_section_to_notes = frozenset([(section, frozenset(notes)) for section, notes in sections_to_notes.items()])  
+        title = soup.find('div', {'class': ['bookTitle']})
+        authors = soup.find('div', {'class': ['authors']})
+        citation = soup.find('div', {'class': ['citation']})
 
-            return cls(
-                title=cls.remove_leading_and_trailing_newlines(title.text) if title else "",
-                authors=cls.remove_leading_and_trailing_newlines(authors.text) if authors else "",
-                citation=cls.remove_leading_and_trailing_newlines(citation.text) if citation else "",
-                tags=cls.extract_tags(
-                    authors=authors.text if authors else "",
-                    title=title.text if title else "",
-                    default_tags=default_tags
-                ),
-                sections_to_notes=frozen_section_to_notes
-            )
-            
+        # single pass in document order, every note belongs to the last section heading seen before it
+        section_heading = ""
+        sections_to_notes: defaultdict[str, list[str]] = defaultdict(list)
+        for div in soup.find_all('div', {'class': ['sectionHeading', 'noteText']}):
+            if 'sectionHeading' in div['class']:
+                section_heading = div.text.strip('\n')
+                continue
+            sections_to_notes[section_heading].append(div.text.strip('\n'))
+        
+        frozen_section_to_notes = frozenset((section, frozenset(notes)) for section, notes in sections_to_notes.items())
+
+        return cls(
+            title=title.text.strip('\n') if title else "",
+            authors=authors.text.strip('\n') if authors else "",
+            citation=citation.text.strip('\n') if citation else "",
+            tags=cls.extract_tags(
+                authors=authors.text if authors else "",
+                title=title.text if title else "",
+                default_tags=default_tags
+            ),
+            sections_to_notes=frozen_section_to_notes
+        )
+        
     @staticmethod
-    def extract_tags(authors:str, title: str, default_tags: list[str]) -> list[str]:
+    def extract_tags(authors:str, title: str, default_tags: list[str]) -> frozenset[str]:
         tags = set(default_tags) # set to avoid duplicates
         
         # region tags from title
-        pattern = r"\w+ \[(.*)\]\s*$"
-        match = re.search(pattern, title)
+        match = _TITLE_TAGS_PATTERN.search(title)
         if match:
             extracted_text = match.group(1)
             parts = extracted_text.split(",")
@@ -78,7 +79,7 @@ class Note():
         
         # region tags from authors
         authors = authors.replace("\n", "").strip()
-        author_parts =re.split("[.,! ]", authors)
+        author_parts = _AUTHOR_SEPARATORS_PATTERN.split(authors)
         author_parts = [part.capitalize() for part in author_parts if part.strip() != ""]
         author_tag = "".join(author_parts)
         tags.add(author_tag)
@@ -87,34 +88,15 @@ class Note():
         return frozenset(tags)
 
 
-    @staticmethod
-    @cache
-    def remove_leading_and_trailing_newlines(string: str):
-        if string and string[0] == '\n':
-            string = string[1:]
-        if string and string[-1] == '\n':
-            string = string[:-1]
-        return string
-    
-    def to_markdown(self) -> str:
-        text = ""
-        text += f"#### {self.authors}\n"
-        text += "\n"
-        text += f"{self.citation}\n"
-        text += "\n"
-    
-        for tag in self.tags:
-            text += f"#{tag}\n"
-        
-        text += f"\n\n- Created: {time.strftime('%Y-%m-%d_%H-%M-%S')}\n"
-        text += "\n---\n\n"
+    def to_markdown(self, created: Optional[str] = None) -> str:
+        parts = [f"#### {self.authors}\n\n{self.citation}\n\n"]
+        parts.extend(f"#{tag}\n" for tag in self.tags)
+        parts.append(f"\n\n- Created: {created or time.strftime('%Y-%m-%d_%H-%M-%S')}\n\n---\n\n")
         
         for section, notes in self.sections_to_notes:
-            text += f"### {section}\n"
-            text += "\n"
-            for note in notes:
-                text += f"- {note}\n"
+            parts.append(f"### {section}\n\n")
+            parts.extend(f"- {note}\n" for note in notes)
                 
-        return text
+        return "".join(parts)
     
     
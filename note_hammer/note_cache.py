@@ -0,0 +1,73 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+from typing import Optional
+
+from note_hammer.note import Note
+
+_logger = logging.getLogger(__name__)
+
+_CACHE_VERSION = b"1" # bump when Note.from_kindle_html output changes, invalidates all cached notes
+
+
+class NoteCache():
+    """
+    On-disk cache of parsed notes, keyed by the content of the Kindle html file and the default tags.
+    Exports that did not change since the last run are not parsed again.
+    """
+    def __init__(self, cache_path: str):
+        self.cache_path = os.path.abspath(cache_path)
+
+    @staticmethod
+    def key(html: bytes, default_tags: list[str]) -> str:
+        hasher = hashlib.sha256(_CACHE_VERSION)
+        hasher.update(html)
+        hasher.update("\n".join(sorted(default_tags)).encode('utf-8'))
+        return hasher.hexdigest()
+
+    def get(self, key: str) -> Optional[Note]:
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path, encoding='utf-8') as fp:
+                entry = json.load(fp)
+            note = Note(
+                title=entry["title"],
+                authors=entry["authors"],
+                citation=entry["citation"],
+                tags=frozenset(entry["tags"]),
+                sections_to_notes=frozenset((section, frozenset(notes)) for section, notes in entry["sections_to_notes"])
+            )
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError, TypeError):
+            # a damaged entry is a miss, the note is parsed again and the entry rewritten
+            _logger.warning(f"NoteHammer: Removing unreadable cache entry {entry_path}")
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(entry_path)
+            return None
+
+        return note
+
+    def put(self, key: str, note: Note):
+        entry = {
+            "title": note.title,
+            "authors": note.authors,
+            "citation": note.citation,
+            "tags": sorted(note.tags),
+            "sections_to_notes": [[section, sorted(notes)] for section, notes in note.sections_to_notes],
+        }
+        os.makedirs(self.cache_path, exist_ok=True)
+        entry_path = self._entry_path(key)
+        temp_entry_path = f"{entry_path}.{os.getpid()}.tmp" # identical html files are put by several worker processes at once
+        with open(temp_entry_path, "w", encoding="utf-8") as fp:
+            json.dump(entry, fp, ensure_ascii=False)
+        os.replace(temp_entry_path, entry_path) # a torn entry would be read back as a broken note
+
+    def clean(self):
+        shutil.rmtree(self.cache_path, ignore_errors=True)
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_path, f"{key}.json")
@@ -1,13 +1,26 @@
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 import datetime
+from functools import partial
 import logging
-import math
+from multiprocessing import Pool
 import os
-import re
+from pathlib import Path
 import shutil
+from typing import Iterable, Iterator, Optional
 import click
 from timeit import default_timer
 from note_hammer.note import Note
+from note_hammer.note_cache import NoteCache
+from note_hammer.utils import batched
+
+_logger = logging.getLogger(__name__)
+
+_MIN_FILES_FOR_PROCESS_POOL = 4 # below this the worker start-up costs more than parsing serially
+_HTML_FILES_PER_WORKER_TASK = 16 # html files sent to a worker process at once, amortizes the inter-process round trip
+_WRITER_THREADS = min(32, (os.cpu_count() or 1) * 4) # writing is open/close latency bound, not CPU bound
+_WRITE_BATCH_SIZE = 128 # notes queued for writing at once, bounds memory when parsing outpaces writing
+_INVALID_FILENAME_CHARS_TABLE = dict.fromkeys(map(ord, '/\\:*?"<>|')) # str.translate table deleting the characters not allowed in file names
 
 
 class NoteHammer():
@@ -18,128 +31,312 @@ class NoteHammer():
         backup_path: str,
         default_tags: list[str] = [],
         overwrite_older_notes: bool = False, 
-        skip_confirmation: bool = False
+        skip_confirmation: bool = False,
+        max_backups: int = 0,
+        cache_path: str = "",
+        clean_cache: bool = False,
+        jobs: Optional[int] = None
     ):
         self.input_path = os.path.abspath(input_path)
         self.output_path = os.path.abspath(output_path)
+        self.output_path_prefix = os.path.join(self.output_path, "") # with a trailing separator, note paths are then a plain concatenation
         self.backup_path = os.path.abspath(backup_path)
         self.default_tags: list[str] = default_tags
         self.overwrite_older_notes: bool = overwrite_older_notes 
         self.skip_confirmation: bool = skip_confirmation
+        self.max_backups: int = max_backups
+        self.note_cache: Optional[NoteCache] = NoteCache(cache_path) if cache_path else None
+        self.clean_cache: bool = clean_cache
+        self.jobs: Optional[int] = jobs
+        self.hard_links_supported: bool = True # cleared once os.link fails on the output folder, see write_note
+        self.timestamp: str = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')  # shared by the backup folder and all notes of this run
     
-    def process_kindle_notes(
-        self, 
-        # input_path: str, 
-        # output_path: str, 
-        # tags: list[str] = [],
-        # overwrite_older_notes: bool = False, 
-        # skip_confirmation: bool = False
-    ):
+    def process_kindle_notes(self):
         start = default_timer()
-        if self.backup_path:
-            logging.info(f"NoteHammer: Backing up notes to {self.backup_path}")
-            self.backup_notes()
-        
-        logging.info(f"NoteHammer: Extracting markdown notes from Kindle html files in {self.input_path}, md files will be saved to {self.output_path}")
-        
-        notes = self.extract_notes()
-        notes = self.remove_duplicate_notes(notes)
-        self.write_notes(
-            notes=notes, 
-        )
+        with ThreadPoolExecutor(max_workers=1) as backup_executor:
+            backup_future = None
+            if self.backup_path:
+                _logger.info(f"NoteHammer: Backing up notes to {self.backup_path}")
+                # the folders this run writes to are left out of the backup (see backup_notes), so it can be copied in the background
+                # while the notes are extracted and written
+                backup_future = backup_executor.submit(self.backup_notes)
+            
+            if self.note_cache and self.clean_cache:
+                _logger.info(f"NoteHammer: Cleaning note cache {self.note_cache.cache_path}")
+                self.note_cache.clean()
+
+            _logger.info(f"NoteHammer: Extracting markdown notes from Kindle html files in {self.input_path}, md files will be saved to {self.output_path}")
+            
+            # a pipeline of generators, notes are deduplicated and written while later html files are still being parsed
+            notes = self.extract_notes()
+            notes = self.remove_duplicate_notes(notes)
+            written_notes_count = self.write_notes(
+                notes=notes, 
+            )
+
+            if backup_future:
+                backup_future.result() # re-raises a failed backup
+                if self.max_backups > 0:
+                    self.prune_backups()
 
         end = default_timer()
 
-        logging.info(f"NoteHammer: Processed {len(notes)} notes in {round(end - start, 2)} seconds")
+        _logger.info(f"NoteHammer: Processed {written_notes_count} notes in {round(end - start, 2)} seconds")
         
     def backup_notes(self):
-        backup_folder = os.path.join(self.backup_path, f"backup_{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}")
+        backup_folder = os.path.join(self.backup_path, f"backup_{self.timestamp}")
+
+        # the output, cache and backup folders can be inside the input folder, they are with the default paths
+        excluded_paths = {os.path.normcase(self.output_path), os.path.normcase(self.backup_path)}
+        if self.note_cache:
+            excluded_paths.add(os.path.normcase(self.note_cache.cache_path))
+        def ignore_excluded_paths(folder: str, names: list[str]) -> list[str]:
+            return [name for name in names if os.path.normcase(os.path.join(folder, name)) in excluded_paths]
 
-        shutil.copytree(self.input_path, backup_folder)
+        shutil.copytree(self.input_path, backup_folder, ignore=ignore_excluded_paths)
 
-    def extract_notes(self) -> list[Note]:
+    def prune_backups(self):
+        # backup folder names end with a sortable timestamp, so name order is age order
+        backup_folders = sorted(entry.path for entry in os.scandir(self.backup_path) if entry.is_dir() and entry.name.startswith("backup_"))
+        for backup_folder in backup_folders[:-self.max_backups]:
+            _logger.info(f"NoteHammer: Removing old backup {backup_folder}")
+            shutil.rmtree(backup_folder)
+
+    def extract_notes(self) -> Iterator[Note]:
         """
         Args:
             input_path (str): Either path to a single HTML file or a directory (or a tree of directories) containing HTML files.
 
-        Returns:
-            list[Note]: _description_
+        Yields:
+            Note: The notes in the order of their html paths.
         """
-        logging.info(f"NoteHammer: Reading html files from {self.input_path}")
+        _logger.info(f"NoteHammer: Reading html files from {self.input_path}")
         
         assert os.path.isdir(self.input_path) or os.path.splitext(self.input_path)[1] == ".html"
-        walk = list(os.walk(self.input_path))
-        notes: list[Note] = []
 
-        if not walk and self.input_path.endswith(".html"):
-            notes.append(Note.from_kindle_html(self.input_path, default_tags=self.default_tags))
+        if os.path.isdir(self.input_path):
+            html_file_paths = sorted(self.iter_html_file_paths(self.input_path)) # materialized, the progress bar needs the count
         else:
-            all_html_file_paths = []
-            for root, dirs, files in walk:
-                all_html_file_paths.extend([os.path.join(root, file) for file in files if file.endswith(".html")])
-            with click.progressbar(all_html_file_paths, label="NoteHammer: Reading html files") as bar:
-                for html_file_path in bar:
-                    notes.append(Note.from_kindle_html(html_file_path, default_tags=self.default_tags))
-        return notes
-
-    def write_notes(self, notes: list[Note]):
-        logging.info(f"NoteHammer: Writing markdown notes to {self.output_path}")
+            html_file_paths = [self.input_path]
+
+        # the progress bar advances as the files finish, the notes are passed on in the order of the html paths, so duplicates
+        # and colliding file names are resolved the same way on every run, whatever the worker timing and cache hits
+        with click.progressbar(self.read_kindle_htmls(html_file_paths), length=len(html_file_paths), label="NoteHammer: Reading html files") as bar:
+            yield from self.order_by_path(html_file_paths, bar)
+
+    @staticmethod
+    def order_by_path(html_file_paths: list[str], read_notes: Iterable[tuple[str, Note]]) -> Iterator[Note]:
+        """
+        Args:
+            html_file_paths (list[str]): Paths to the Kindle html files, in the order the notes are yielded.
+            read_notes (Iterable[tuple[str, Note]]): The html paths and their notes, in any order.
+
+        Yields:
+            Note: Each note as soon as the notes of all the html paths before it are read.
+        """
+        path_indexes = {html_file_path: index for index, html_file_path in enumerate(html_file_paths)}
+        early_notes: dict[int, Note] = {}
+        next_index = 0
+        for html_file_path, note in read_notes:
+            early_notes[path_indexes[html_file_path]] = note
+            while next_index in early_notes:
+                yield early_notes.pop(next_index)
+                next_index += 1
+
+    def read_kindle_htmls(self, html_file_paths: list[str]) -> Iterator[tuple[str, Note]]:
+        """
+        Reads the notes from the cache or parses the html files, in worker processes when there are enough files.
+        Parsing is CPU bound and each file is independent, notes are yielded as soon as they are read,
+        a large html file does not hold back the ones after it.
+
+        Args:
+            html_file_paths (list[str]): Paths to the Kindle html files.
+
+        Yields:
+            tuple[str, Note]: The html path and its note, in the order the files finish.
+        """
+        read_kindle_html = partial(_read_kindle_html, default_tags=self.default_tags, note_cache=self.note_cache)
+        use_pool = len(html_file_paths) >= _MIN_FILES_FOR_PROCESS_POOL and self.jobs != 1
+        reused_notes_count = 0
+        with Pool(processes=self.jobs) if use_pool else nullcontext() as pool:
+            if pool:
+                read_notes = pool.imap_unordered(read_kindle_html, html_file_paths, chunksize=_HTML_FILES_PER_WORKER_TASK)
+            else:
+                read_notes = map(read_kindle_html, html_file_paths)
+            for html_file_path, note, from_cache in read_notes:
+                reused_notes_count += from_cache
+                yield html_file_path, note
+
+        if self.note_cache:
+            _logger.info(f"NoteHammer: Reused {reused_notes_count} of {len(html_file_paths)} notes from cache {self.note_cache.cache_path}")
+
+    @staticmethod
+    def iter_html_file_paths(folder_path: str) -> Iterator[str]:
+        # a generator over scandir entries, no per-directory name lists are built as with os.walk
+        try:
+            entries = os.scandir(folder_path)
+        except OSError as error:
+            # like os.walk, a folder that cannot be read (e.g. System Volume Information on a drive root) does not stop the run
+            _logger.warning(f"NoteHammer: Skipping folder {folder_path} because it cannot be read: {error}")
+            return
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from NoteHammer.iter_html_file_paths(entry.path)
+                elif entry.name.endswith(".html"):
+                    yield entry.path
+
+    def write_notes(self, notes: Iterable[Note]) -> int:
+        """
+        Args:
+            notes (Iterable[Note]): Notes to write, writing starts as soon as the first note is available.
+
+        Returns:
+            int: Number of notes handed over for writing.
+        """
+        _logger.info(f"NoteHammer: Writing markdown notes to {self.output_path}")
         
         if not os.path.exists(self.output_path):
             os.makedirs(self.output_path)
         
         assert os.path.isdir(self.output_path)
-        for note in notes:
-            self.write_note(note)
-
-    def write_note(self, note: Note):
-        filename = self.remove_invalid_chars_from_filename(self.remove_tags(note.title)) + ".md"
-        filepath = os.path.join(self.output_path, filename)
-        
-        if not self.overwrite_older_notes and os.path.exists(filepath):
-            logging.warning(f"NoteHammer: Skipping file {filepath} because it already exists . Use -o or --overwrite-older-notes flag to overwrite such notes")
-            return
+        # file names are compared casefolded, names differing only in case are the same file on Windows and macOS
+        existing_filenames = {filename.casefold() for filename in os.listdir(self.output_path)} # a single listing instead of an exists check per note
         
+        # different notes can clean up to the same file name, later ones get the first free _2, _3, ... suffix
+        # every note then has its own file and the writes can run in parallel without locking
+        assigned_filenames: set[str] = set()
+        def get_unique_filename(note: Note) -> str:
+            clean_title = self.clean_title(note.title)
+            filename = f"{clean_title}.md"
+            suffix = 1
+            while filename.casefold() in assigned_filenames:
+                suffix += 1
+                filename = f"{clean_title}_{suffix}.md"
+            assigned_filenames.add(filename.casefold())
+            return filename
+
+        def write_note_to(note: Note, filename: str):
+            self.write_note(note, f"{self.output_path_prefix}{filename}", exists=filename.casefold() in existing_filenames)
+
         if not self.skip_confirmation:
-            confirmed = click.confirm(f'Are you sure you want to overwrite existing note {filepath}? Use -sc or --skip-confirmations flag to not get asked again.', abort=False)
-            if not confirmed:
-                logging.info(f"NoteHammer: Skipping file {filepath} because it already exists")
+            # confirmations are interactive, finish reading first so the prompts do not interleave with the progress bar
+            notes = list(notes)
+            for note in notes:
+                write_note_to(note, get_unique_filename(note))
+            return len(notes)
+
+        notes_count = 0
+        pending_writes = []
+        with ThreadPoolExecutor(max_workers=_WRITER_THREADS) as executor:
+            for batch in batched(notes, _WRITE_BATCH_SIZE):
+                # the previous batch was being written while this one was read, let it finish before queueing more
+                for future in pending_writes:
+                    future.result() # re-raises errors from the writer threads
+
+                pending_writes = [executor.submit(write_note_to, note, get_unique_filename(note)) for note in batch]
+                notes_count += len(batch)
+
+            for future in pending_writes:
+                future.result()
+        return notes_count
+
+    def get_note_filepath(self, note: Note) -> str:
+        return f"{self.output_path_prefix}{self.clean_title(note.title)}.md"
+
+    def write_note(self, note: Note, filepath: Optional[str] = None, exists: Optional[bool] = None):
+        filepath = filepath or self.get_note_filepath(note)
+        
+        if exists is None:
+            exists = os.path.exists(filepath)
+        if exists:
+            if not self.overwrite_older_notes:
+                _logger.warning(f"NoteHammer: Skipping file {filepath} because it already exists . Use -o or --overwrite-older-notes flag to overwrite such notes")
                 return
+            if not self.skip_confirmation:
+                confirmed = click.confirm(f'Are you sure you want to overwrite existing note {filepath}? Use -sc or --skip-confirmations flag to not get asked again.', abort=False)
+                if not confirmed:
+                    _logger.info(f"NoteHammer: Skipping file {filepath} because it already exists")
+                    return
+            _logger.info(f"NoteHammer: Overwriting {filepath}")
         
-        if os.path.exists(filepath):
-            logging.info(f"NoteHammer: Overwriting {filepath}")
-        with open(filepath, "w",  encoding="utf-8") as file:
-            note_as_md = note.to_markdown()
+        note_as_md = note.to_markdown(created=self.timestamp)
+        if not self.overwrite_older_notes and not self.hard_links_supported:
+            self.create_note_file(filepath, note_as_md)
+            return
+        
+        # the note is complete in a temporary file before it gets its name, an interrupted run never leaves a truncated note behind
+        temp_filepath = filepath + ".tmp"
+        with open(temp_filepath, "w",  encoding="utf-8") as file:
             file.write(note_as_md)
+        
+        if self.overwrite_older_notes:
+            os.replace(temp_filepath, filepath)
+            return
+        
+        # a hard link claims the name atomically too, but fails instead of replacing a note created since the check above
+        try:
+            os.link(temp_filepath, filepath)
+        except FileExistsError:
+            _logger.warning(f"NoteHammer: Skipping file {filepath} because it already exists . Use -o or --overwrite-older-notes flag to overwrite such notes")
+        except OSError:
+            # FAT32, exFAT and many cloud-synced folders have no hard links, new notes are then created with an exclusive open
+            _logger.info(f"NoteHammer: Hard links are not supported in {self.output_path}, creating new notes directly")
+            self.hard_links_supported = False
+            self.create_note_file(filepath, note_as_md)
+        finally:
+            os.remove(temp_filepath)
+
+    def create_note_file(self, filepath: str, note_as_md: str):
+        # exclusive create checks for an older note and claims the name in a single call, no race between check and write
+        try:
+            with open(filepath, "x",  encoding="utf-8") as file:
+                file.write(note_as_md)
+        except FileExistsError:
+            _logger.warning(f"NoteHammer: Skipping file {filepath} because it already exists . Use -o or --overwrite-older-notes flag to overwrite such notes")
     
     @staticmethod     
-    def remove_duplicate_notes(notes: list[Note]) -> list[Note]:
-        logging.info("NoteHammer: Removing duplicate notes")
+    def remove_duplicate_notes(notes: Iterable[Note]) -> Iterator[Note]:
+        _logger.info("NoteHammer: Removing duplicate notes")
         
-        note_freq = defaultdict(int)
+        seen_notes: set[Note] = set()
         for note in notes:
-            note_freq[note] += 1
-
-        unique_notes = []
-        duplicates = []
-        for note, freq in note_freq.items():
-            if freq == 1:
-                unique_notes.append(note)
-            else:
-                duplicates.extend([note] * freq)
-        for duplicate in duplicates:
-            logging.warning(f"NoteHammer: Removed duplicate note {duplicate.title}")
-        return unique_notes
+            if note in seen_notes:
+                _logger.warning(f"NoteHammer: Removed duplicate note {note.title}")
+                continue
+            seen_notes.add(note)
+            yield note
 
     @staticmethod
     def remove_tags(string: str) -> str:
-        last_index_of_opening_bracket = string.rfind('[')
-        if last_index_of_opening_bracket == -1:
-            return string.strip()
-        else:
-            return string[:last_index_of_opening_bracket].strip()
+        before_tags, opening_bracket, _ = string.rpartition('[')
+        return (before_tags if opening_bracket else string).strip()
+
+    @staticmethod
+    def clean_title(title: str) -> str:
+        return NoteHammer.remove_tags(title).translate(_INVALID_FILENAME_CHARS_TABLE)
 
     @staticmethod
     def remove_invalid_chars_from_filename(filename_with_invalid_chars: str) -> str:
-        pattern = re.compile('[/\\:*?"<>|]')
-        return pattern.sub('', filename_with_invalid_chars)
+        return filename_with_invalid_chars.translate(_INVALID_FILENAME_CHARS_TABLE)
+
+
+def _read_kindle_html(html_path: str, default_tags: list[str], note_cache: Optional[NoteCache]) -> tuple[str, Note, bool]:
+    """
+    Runs in the worker processes, the file is read once for both the cache key and the parser.
+
+    Returns:
+        tuple[str, Note, bool]: The html path, its note and whether the note was reused from the cache.
+    """
+    html = Path(html_path).read_bytes()
+    if note_cache is None:
+        return html_path, Note.from_kindle_html_bytes(html, default_tags=default_tags), False
+
+    key = NoteCache.key(html, default_tags)
+    note = note_cache.get(key)
+    if note is not None:
+        return html_path, note, True
+
+    note = Note.from_kindle_html_bytes(html, default_tags=default_tags)
+    note_cache.put(key, note)
+    return html_path, note, False
@@ -1,6 +1,10 @@
+from itertools import islice
 import shutil
 import time
 import os
+from typing import Iterable, Iterator, TypeVar
+
+T = TypeVar("T")
 
 def create_timestamped_backup(folder_path: str, backup_path: str) -> None:
     # Get the current timestamp in a formatted string
@@ -14,4 +18,11 @@ def create_timestamped_backup(folder_path: str, backup_path: str) -> None:
     timestamped_backup_folder = os.path.join(backup_path, timestamp)
 
     # Copy the contents of the folder to the timestamped backup folder
-    shutil.copytree(folder_path, timestamped_backup_folder)
\ No newline at end of file
+    shutil.copytree(folder_path, timestamped_backup_folder)
+
+
+def batched(iterable: Iterable[T], batch_size: int) -> Iterator[list[T]]:
+    # itertools.batched is only available from Python 3.12
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
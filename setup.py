@@ -7,6 +7,7 @@ setup(
     install_requires=[
         'click',
         'beautifulsoup4',
+        'lxml',
     ],
     entry_points='''
         [console_scripts]
@@ -0,0 +1,40 @@
+import glob
+import os
+from pathlib import Path
+import tempfile
+import unittest
+
+from note_hammer.note import Note
+from note_hammer.note_cache import NoteCache
+
+EXPORTED_NOTES_PATH = os.path.join(os.path.dirname(__file__), "..", "test_resources", "exported notes")
+
+
+class NoteCacheTest(unittest.TestCase):
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as cache_path:
+            note_cache = NoteCache(cache_path)
+            for html_path in glob.glob(os.path.join(EXPORTED_NOTES_PATH, "*.html")):
+                key = note_cache.key(Path(html_path).read_bytes(), ["NoteHammer"])
+                self.assertIsNone(note_cache.get(key))
+                note = Note.from_kindle_html(html_path, default_tags=["NoteHammer"])
+                note_cache.put(key, note)
+                self.assertEqual(note_cache.get(key), note)
+
+    def test_damaged_entry_is_a_miss(self):
+        with tempfile.TemporaryDirectory() as cache_path:
+            note_cache = NoteCache(cache_path)
+            for content in ["{bad", "[]", '{"title": "only a title"}']:
+                with open(os.path.join(cache_path, "damaged.json"), "w", encoding="utf-8") as fp:
+                    fp.write(content)
+                self.assertIsNone(note_cache.get("damaged"))
+                self.assertFalse(os.path.exists(os.path.join(cache_path, "damaged.json")))
+
+    def test_key_depends_on_default_tags(self):
+        html = Path(glob.glob(os.path.join(EXPORTED_NOTES_PATH, "*.html"))[0]).read_bytes()
+        self.assertEqual(NoteCache.key(html, ["a", "b"]), NoteCache.key(html, ["b", "a"]))
+        self.assertNotEqual(NoteCache.key(html, ["a"]), NoteCache.key(html, ["b"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,175 @@
+import glob
+import itertools
+import os
+import tempfile
 import unittest
+from unittest import mock
 import sys
 
+from note_hammer.note import Note
 from note_hammer.note_hammer import NoteHammer
 # sys.path.append(r"C:\Projects\WeldChecker\weld_checker")
 
+EXPORTED_NOTES_PATH = os.path.join(os.path.dirname(__file__), "..", "test_resources", "exported notes")
+
+
+def make_note(title: str, highlight: str = "") -> Note:
+    return Note(title=title, authors="", citation="", tags=frozenset(), sections_to_notes=frozenset([("section", frozenset([highlight]))]))
+
 
 class note_hammerTest(unittest.TestCase):
-    ...
+    def test_remove_invalid_chars_from_filename(self):
+        self.assertEqual(NoteHammer.remove_invalid_chars_from_filename("hello world"), "hello world")
+        self.assertEqual(NoteHammer.remove_invalid_chars_from_filename('a/b\\c:d*e?f"g<h>i|j'), "abcdefghij")
+        self.assertEqual(NoteHammer.remove_invalid_chars_from_filename("Naval Gazing Main-A Brief History"), "Naval Gazing Main-A Brief History")
+        
+    def test_remove_tags(self):
+        self.assertEqual(NoteHammer.remove_tags("hello"), "hello")
+        self.assertEqual(NoteHammer.remove_tags("hello [world]"), "hello")
+        self.assertEqual(NoteHammer.remove_tags(" hello [a] [b] "), "hello [a]")
+        self.assertEqual(NoteHammer.remove_tags("hello [world"), "hello")
+        self.assertEqual(NoteHammer.remove_tags("[world]"), "")
+        
+    def test_clean_title(self):
+        titles = ["hello", "hello [world]", 'a/b\\c:d [e]', "Naval Gazing Main-A Brief History [NavalGazing] ", "what? [x, y] [z]", "[world]", "abc : [x]"]
+        for title in titles:
+            self.assertEqual(NoteHammer.clean_title(title), NoteHammer.remove_invalid_chars_from_filename(NoteHammer.remove_tags(title)))
+        
+    def test_remove_duplicate_notes(self):
+        notes = [make_note("a", "1"), make_note("b", "1"), make_note("a", "1"), make_note("a", "2"), make_note("b", "1")]
+        self.assertListEqual(list(NoteHammer.remove_duplicate_notes(notes)), [make_note("a", "1"), make_note("b", "1"), make_note("a", "2")])
+        self.assertListEqual(list(NoteHammer.remove_duplicate_notes(iter(notes[:2]))), notes[:2])
+
+    def test_read_kindle_htmls(self):
+        html_paths = sorted(glob.glob(os.path.join(EXPORTED_NOTES_PATH, "*.html")))
+        expected = {html_path: Note.from_kindle_html(html_path, default_tags=["NoteHammer"]) for html_path in html_paths}
+        with tempfile.TemporaryDirectory() as cache_path:
+            for jobs in [1, 2]:
+                note_hammer = NoteHammer(input_path=EXPORTED_NOTES_PATH, output_path=cache_path, backup_path="", default_tags=["NoteHammer"], cache_path=cache_path, jobs=jobs)
+                # parsed on the first pass, reused from the cache on the second one
+                for _ in range(2):
+                    read_notes = list(note_hammer.read_kindle_htmls(html_paths))
+                    self.assertCountEqual([html_path for html_path, _ in read_notes], html_paths)
+                    self.assertDictEqual(dict(read_notes), expected)
+
+    def test_iter_html_file_paths_skips_unreadable_folders(self):
+        with tempfile.TemporaryDirectory() as input_path:
+            for folder in ["readable", "unreadable"]:
+                os.mkdir(os.path.join(input_path, folder))
+                open(os.path.join(input_path, folder, "a.html"), "w").close()
+
+            scandir = os.scandir
+            def scandir_failing_on_unreadable(path):
+                if os.path.basename(path) == "unreadable":
+                    raise PermissionError(13, "Permission denied", path)
+                return scandir(path)
+
+            with mock.patch("os.scandir", scandir_failing_on_unreadable):
+                html_file_paths = list(NoteHammer.iter_html_file_paths(input_path))
+            self.assertListEqual(html_file_paths, [os.path.join(input_path, "readable", "a.html")])
+
+    def test_backup_notes_leaves_out_written_folders(self):
+        with tempfile.TemporaryDirectory() as input_path:
+            for folder in ["export", "backup", "cache", "kindle"]:
+                os.mkdir(os.path.join(input_path, folder))
+            for file in [os.path.join("kindle", "a.html"), os.path.join("export", "a.md")]:
+                open(os.path.join(input_path, file), "w").close()
+
+            note_hammer = NoteHammer(
+                input_path=input_path,
+                output_path=os.path.join(input_path, "export"),
+                backup_path=os.path.join(input_path, "backup"),
+                cache_path=os.path.join(input_path, "cache")
+            )
+            note_hammer.backup_notes()
+            backup_folder = os.path.join(input_path, "backup", f"backup_{note_hammer.timestamp}")
+            self.assertListEqual(os.listdir(backup_folder), ["kindle"])
+            self.assertListEqual(os.listdir(os.path.join(backup_folder, "kindle")), ["a.html"])
+
+    def test_same_title_notes_get_the_same_files_in_any_arrival_order(self):
+        html_file_paths = ["1.html", "2.html", "3.html"]
+        notes = [make_note("a", "first"), make_note("a [x]", "second"), make_note("a", "third")]
+        outputs = set()
+        for read_notes in itertools.permutations(zip(html_file_paths, notes)):
+            with tempfile.TemporaryDirectory() as output_path:
+                note_hammer = NoteHammer(input_path=output_path, output_path=output_path, backup_path="", skip_confirmation=True)
+                note_hammer.timestamp = "2023-01-01_12-00-00" # the notes are compared including their created line
+                note_hammer.write_notes(NoteHammer.order_by_path(html_file_paths, read_notes))
+                output = {}
+                for filename in os.listdir(output_path):
+                    with open(os.path.join(output_path, filename), encoding="utf-8") as file:
+                        output[filename] = file.read()
+                outputs.add(frozenset(output.items()))
+        self.assertEqual(len(outputs), 1)
+        self.assertSetEqual({filename for filename, _ in next(iter(outputs))}, {"a.md", "a_2.md", "a_3.md"})
+
+    def test_prune_backups(self):
+        with tempfile.TemporaryDirectory() as backup_path:
+            backup_folders = [f"backup_2023-01-0{day}_12-00-00" for day in range(1, 5)]
+            for folder in backup_folders + ["unrelated"]:
+                os.mkdir(os.path.join(backup_path, folder))
+
+            NoteHammer(input_path=backup_path, output_path=backup_path, backup_path=backup_path, max_backups=0).prune_backups()
+            self.assertListEqual(sorted(os.listdir(backup_path)), backup_folders + ["unrelated"])
+
+            NoteHammer(input_path=backup_path, output_path=backup_path, backup_path=backup_path, max_backups=2).prune_backups()
+            self.assertListEqual(sorted(os.listdir(backup_path)), backup_folders[2:] + ["unrelated"])
+
+    def test_write_note_keeps_older_note(self):
+        with tempfile.TemporaryDirectory() as output_path:
+            note_hammer = NoteHammer(input_path=output_path, output_path=output_path, backup_path="", skip_confirmation=True)
+            note = make_note("a")
+            with open(os.path.join(output_path, "a.md"), "w", encoding="utf-8") as file:
+                file.write("older note")
+            # exists=False, as if the older note appeared after the output folder was listed
+            note_hammer.write_note(note, os.path.join(output_path, "a.md"), exists=False)
+            self.assertListEqual(os.listdir(output_path), ["a.md"])
+            with open(os.path.join(output_path, "a.md"), encoding="utf-8") as file:
+                self.assertEqual(file.read(), "older note")
+
+    def test_write_notes_without_hard_links(self):
+        def link_not_supported(source, destination):
+            raise PermissionError(1, "Operation not permitted", source)
+
+        with tempfile.TemporaryDirectory() as output_path:
+            with open(os.path.join(output_path, "c.md"), "w", encoding="utf-8") as file:
+                file.write("older note")
+            note_hammer = NoteHammer(input_path=output_path, output_path=output_path, backup_path="", skip_confirmation=True)
+            with mock.patch("os.link", link_not_supported):
+                self.assertEqual(note_hammer.write_notes([make_note("a", "first"), make_note("b", "second"), make_note("c", "third")]), 3)
+                # as if c.md appeared after the output folder was listed
+                note_hammer.write_note(make_note("c", "third"), os.path.join(output_path, "c.md"), exists=False)
+            self.assertCountEqual(os.listdir(output_path), ["a.md", "b.md", "c.md"])
+            for filename, content in [("a.md", "first"), ("b.md", "second"), ("c.md", "older note")]:
+                with open(os.path.join(output_path, filename), encoding="utf-8") as file:
+                    self.assertIn(content, file.read())
+
+    def test_write_notes_suffixes_colliding_filenames(self):
+        with tempfile.TemporaryDirectory() as output_path:
+            note_hammer = NoteHammer(input_path=output_path, output_path=output_path, backup_path="", skip_confirmation=True)
+            notes = [make_note("a [x]", "first"), make_note("a: [y]", "second"), make_note("b", "third"), make_note("a", "fourth")]
+            self.assertEqual(note_hammer.write_notes(notes), 4)
+            self.assertListEqual(sorted(os.listdir(output_path)), ["a.md", "a_2.md", "a_3.md", "b.md"])
+            with open(os.path.join(output_path, "a_3.md"), encoding="utf-8") as file:
+                self.assertIn("fourth", file.read())
+
+    def test_write_notes_never_reuses_a_filename(self):
+        # a suffixed name can also be the clean title of another note, and names differing only in case are one file on Windows
+        cases = [
+            ([("a", "first"), ("a", "second"), ("a_2", "third")], ["a.md", "a_2.md", "a_2_2.md"]),
+            ([("a_2", "first"), ("a", "second"), ("a", "third")], ["a_2.md", "a.md", "a_3.md"]),
+            ([("A", "first"), ("a", "second")], ["A.md", "a_2.md"]),
+        ]
+        for titles_and_highlights, filenames in cases:
+            with tempfile.TemporaryDirectory() as output_path:
+                note_hammer = NoteHammer(input_path=output_path, output_path=output_path, backup_path="", overwrite_older_notes=True, skip_confirmation=True)
+                notes = [make_note(title, highlight) for title, highlight in titles_and_highlights]
+                self.assertEqual(note_hammer.write_notes(notes), len(notes))
+                self.assertCountEqual(os.listdir(output_path), filenames)
+                for (_, highlight), filename in zip(titles_and_highlights, filenames):
+                    with open(os.path.join(output_path, filename), encoding="utf-8") as file:
+                        self.assertIn(highlight, file.read())
+        
     # def test_extract_tags(self):
     #     note_hammer = note_hammer()
     #     self.assertListEqual(note_hammer.extract_tags("hello [world]"), ["world"])